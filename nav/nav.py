@@ -1,7 +1,7 @@
+import array
 import collections
 import math
 import numpy as np
-import scipy
 import itertools
 
 from vision_msgs.msg import Detection2DArray
@@ -49,7 +49,8 @@ class Nav(Node):
             self.create_publisher(Image, "debug_image", 10)
 
         self.num_grid_cells = 101
-        self.num_orientation_cells = 64
+        self.declare_parameter("num_orientation_cells", 64)
+        self.num_orientation_cells = self.get_parameter("num_orientation_cells").get_parameter_value().integer_value
         self.grid_cells_origin_x = -1.5
         self.grid_cells_origin_y = -1.5
         self.world_grid_length = 3.0
@@ -59,16 +60,20 @@ class Nav(Node):
         self.state = self.stopped
         self.detections = None
         self.bridge = CvBridge()
-        self.inertial_nav = inertial_nav_mod.InertialNav(self.num_grid_cells, self.num_orientation_cells, "Uniform")
-        self.vision_nav = vision_nav_mod.VisionNav(self.num_grid_cells, self.num_orientation_cells)
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # The 3x3 box filter smoothing the occupancy grid, split into separable row and column passes.
+        self.occupancy_row_kernel = torch.ones([1, 1, 1, 3], device=self.device)
+        self.occupancy_column_kernel = torch.ones([1, 1, 3, 1], device=self.device)
+        self.inertial_nav = inertial_nav_mod.InertialNav(self.num_grid_cells, self.num_orientation_cells, "Uniform", self.device)
+        self.vision_nav = vision_nav_mod.VisionNav(self.num_grid_cells, self.num_orientation_cells, self.device)
         self.tf_static_broadcaster = StaticTransformBroadcaster(self)
         self.publish_occupancy_grid_msg(self.inertial_nav.current_probability_map, PoseStamped().header)
 
 
     def publish_occupancy_grid_msg(self, pose_probability_map, header):
-        myprobs = torch.sum(pose_probability_map, axis=2)
-        kernel = torch.ones([1, 1, 3, 3])
-        conv = torch.nn.functional.conv2d(myprobs.unsqueeze(0), kernel, padding=1)[0]
+        myprobs = torch.sum(pose_probability_map.float(), axis=2)
+        conv = torch.nn.functional.conv2d(myprobs.unsqueeze(0), self.occupancy_row_kernel, padding=(0, 1))
+        conv = torch.nn.functional.conv2d(conv, self.occupancy_column_kernel, padding=(1, 0))[0]
         prob_map_msg = OccupancyGrid()
         prob_map_msg.header = header
         prob_map_msg.header.frame_id = "map"
@@ -78,12 +83,15 @@ class Nav(Node):
         prob_map_msg.info.origin.position.x = self.grid_cells_origin_x
         prob_map_msg.info.origin.position.y = self.grid_cells_origin_y
         conv = conv/conv.max()
-        prob_map_msg.data = torch.flip(100.0 * conv, dims=[0]).type(torch.int).flatten().tolist()
+        occupancy = torch.flip(100.0 * conv, dims=[0]).to(torch.int8).contiguous().cpu().numpy()
+        prob_map_msg.data = array.array('b', occupancy.tobytes())
         self.probmap_publisher.publish(prob_map_msg)
 
     def get_location_MLE(self, pose_probability_map):
-        loc = (pose_probability_map==torch.max(pose_probability_map)).nonzero()[0]
-        orientation = pose_probability_map[loc[0], loc[1]].argmax()
+        _, width, num_orientations = pose_probability_map.shape
+        flat_idx = torch.argmax(pose_probability_map).item()
+        loc = [flat_idx // (width * num_orientations), (flat_idx // num_orientations) % width]
+        orientation = flat_idx % num_orientations
         return (loc, orientation)
 
     def publish_pose_msg1(self, pose_probability_map, header):
@@ -149,7 +157,7 @@ class Nav(Node):
             labels.append("debug_"+obj_label)
             boxes.append(box)
         if len(boxes) != 0:
-            tensor_boxes = torch.stack(boxes)
+            tensor_boxes = torch.stack(boxes).cpu()
             print("Box=", boxes)
             debug_image = draw_bounding_boxes(torch.tensor(image), tensor_boxes,
                                               labels, colors="green")
@@ -22,8 +22,23 @@ CameraPoint = collections.namedtuple("CameraPoint", "x, y")
 BoundingBoxes = collections.namedtuple("BoundingBoxes", "center_x, center_y, width, height")  # Grid of bounding boxes
 Detections = collections.namedtuple("Detections", "labels, bounding_boxes, detection_probabilities")
 
+
+@torch.compile(dynamic=False)
+def box_likelihood(pose_boxes, detected_box, scale):
+    """Elementwise Normal likelihood of detected_box, a tensor of (center_x, center_y, width, height),
+    given the grid of pose_boxes. Compiled so the whole expression runs as one fused kernel.
+    """
+    log_normalizer = -4.0 * math.log(scale * math.sqrt(2.0 * math.pi))
+    res = (-0.5 / (scale * scale)) * (
+        (pose_boxes.center_x - detected_box[0]).square() +
+        (pose_boxes.center_y - detected_box[1]).square() +
+        (pose_boxes.width - detected_box[2]).square() +
+        (pose_boxes.height - detected_box[3]).square())
+    return torch.exp(res + log_normalizer)
+
+
 class VisionNav(Node):
-    def __init__(self, num_grid_cells, num_orientation_cells):
+    def __init__(self, num_grid_cells, num_orientation_cells, device):
         super().__init__("vision_nav_node")
         self.world_dog = WorldObject("dog",
             WorldPoint(1.5, 0.0, 0.27),
@@ -41,23 +56,34 @@ class VisionNav(Node):
                                      )
         self.num_grid_cells = num_grid_cells
         self.num_orientation_cells = num_orientation_cells
+        self.device = device
 
         self.world_grid_length = 3.0
         self.world_cell_size = self.world_grid_length/self.num_grid_cells
         self.world_z = .22
 
-        self.world_position = (torch.arange(self.num_grid_cells)+0.5) * self.world_cell_size - self.world_grid_length/2.0
+        self.world_position = (torch.arange(self.num_grid_cells, device=self.device)+0.5) * self.world_cell_size - self.world_grid_length/2.0
         self.world_xs = self.world_position
         self.world_ys = torch.flip(self.world_position, dims=[0])
-        self.world_thetas = torch.arange(self.num_orientation_cells)*2*math.pi/self.num_orientation_cells
-        self.world_x, self.world_y, self.world_theta = torch.meshgrid(self.world_xs, self.world_ys, self.world_thetas, indexing='xy')
-
-        world_dog_boxes = self.world_to_bounding_boxes(self.world_dog)
-        world_cat_boxes = self.world_to_bounding_boxes(self.world_cat)
+        self.world_thetas = torch.arange(self.num_orientation_cells, device=self.device)*2*math.pi/self.num_orientation_cells
+        # Positions are [H, W, 1] and orientations [1, 1, num_orientation_cells], they broadcast to the full pose grid.
+        world_x, world_y = torch.meshgrid(self.world_xs, self.world_ys, indexing='xy')
+        self.world_x, self.world_y = world_x.unsqueeze(-1), world_y.unsqueeze(-1)
+        self.world_theta = self.world_thetas.view(1, 1, -1)
+        self.cos_theta = torch.cos(self.world_theta)
+        self.sin_theta = torch.sin(self.world_theta)
+        self.pose_grid_shape = [self.num_grid_cells, self.num_grid_cells, self.num_orientation_cells]
+
+        world_objects = [self.world_dog, self.world_cat]
+        self.object_list = [world_object.name for world_object in world_objects]
+        # Bounding boxes and detection probabilities of all objects, stacked along a leading object dimension.
+        world_boxes = [self.world_to_bounding_boxes(world_object) for world_object in world_objects]
+        self.object_bounding_boxes = BoundingBoxes(*(torch.stack(coords) for coords in zip(*world_boxes)))
+        self.object_detection_probabilities = self.box_probability(self.object_bounding_boxes)
         self.object_dictionary = {
-            "dog": Detections(None, world_dog_boxes, self.box_probability(world_dog_boxes)),
-            "cat": Detections(None, world_cat_boxes, self.box_probability(world_cat_boxes))}
-        self.object_list = list(self.object_dictionary.keys())
+            name: Detections(None, BoundingBoxes(*(coords[idx] for coords in self.object_bounding_boxes)),
+                             self.object_detection_probabilities[idx])
+            for idx, name in enumerate(self.object_list)}
         self.bridge = CvBridge()
         self.model = detection_model.fasterrcnn_mobilenet_v3_large_320_fpn(
             weights="FasterRCNN_MobileNet_V3_Large_320_FPN_Weights.COCO_V1",
@@ -70,87 +96,69 @@ class VisionNav(Node):
             self.create_publisher(Image, "annotated_image", 10)
 
     def prob_map(self, pose_boxes, detected_box):
-        scale = 25.0
-        res1 = torch.distributions.normal.Normal(pose_boxes.center_x, scale).log_prob(torch.tensor(detected_box.center_x))
-        res2 = torch.distributions.normal.Normal(pose_boxes.width, scale).log_prob(torch.tensor(detected_box.width))
-        res3 = torch.distributions.normal.Normal(pose_boxes.height, scale).log_prob(torch.tensor(detected_box.height))
-        res4 = torch.distributions.normal.Normal(pose_boxes.center_y, scale).log_prob(
-            torch.tensor(detected_box.center_y))
-        res = res1 + res2 + res3 + res4
-        mynorm = res # - torch.logsumexp(res, dim=[0, 1, 2], keepdim=False)
-        smyprobs = torch.exp(mynorm)
-        return smyprobs
-
-    def probmessage_cond_a(self, detections_msg, proposals):
-        # detections is Detections list, proposals is list of world_boxes
-        # loop through proposals assign to a detection and recurse
+        """Likelihood of detected_box given the predicted pose_boxes, an independent Normal on each box coordinate."""
+        detected = torch.tensor([float(coord) for coord in detected_box], device=self.device)
+        return box_likelihood(pose_boxes, detected, 25.0)
+
+    def probmessage_cond_a(self, detections, proposals, cache, compatible):
+        # detections is Detections list, proposals is list of indices into object_list
+        # each assignment of proposals to distinct detections contributes the product of its cached prob_maps,
+        # detections left unassigned are explained as random.
+        # compatible[detection_idx][object_idx] is True when the detection's label matches the object.
         prob_dist_random = 0.05 * 0.01 * 0.01 * 0.01 * 0.01
-        prob_dist_random_boxes = prob_dist_random+(self.world_x*0.0)
-        if proposals == []:
-            return prob_dist_random_boxes**len(detections_msg.labels)
-        proposal, *remaining_proposals = proposals
-        cum_prob = self.world_x * 0.0
-        for assign_idx in range(len(detections_msg.labels)):
-            rem_detections = detections_msg[:assign_idx] + detections_msg[assign_idx+1:]
-            rem_detections = Detections(
-                detections_msg[0][:assign_idx] + detections_msg[0][assign_idx+1:],
-                detections_msg[1][:assign_idx] + detections_msg[1][assign_idx + 1:],
-                detections_msg[2][:assign_idx] + detections_msg[2][assign_idx + 1:]
-                                        )
-            proposal_name = self.object_list[proposal]
-            prob_assignment = self.prob_map(self.object_dictionary[proposal_name].bounding_boxes, BoundingBoxes(
-                                            detections_msg.bounding_boxes.center_x[assign_idx],
-                                            detections_msg.bounding_boxes.center_y[assign_idx],
-                                            detections_msg.bounding_boxes.width[assign_idx],
-                                            detections_msg.bounding_boxes.height[assign_idx]) )
-            if proposal_name != detections_msg.labels[assign_idx]:
-                prob_assignment = prob_assignment * 0.0
-            rem_prob = self.probmessage_cond_a(rem_detections, remaining_proposals)
-            total_prob = prob_assignment * rem_prob
-            cum_prob += total_prob / len(detections_msg)
-        return cum_prob
+        num_detections = len(detections.labels)
+        cum_prob = torch.zeros(self.pose_grid_shape, device=self.device)
+        for assignment in itertools.permutations(range(num_detections), len(proposals)):
+            if not all(compatible[assign_idx][proposal] for assign_idx, proposal in zip(assignment, proposals)):
+                continue
+            prob_assignment = 1.0
+            for assign_idx, proposal in zip(assignment, proposals):
+                prob_assignment = prob_assignment * cache[(assign_idx, proposal)]
+            cum_prob.add_(prob_assignment)
+        return cum_prob * (prob_dist_random**(num_detections - len(proposals)) / len(detections)**len(proposals))
 
     def probmessage(self, image, header):
         detections, annotated_image = self.detect_image(image, header)
-        comb = list(itertools.product([False,True], repeat=2))
-        s = self.world_x * 0.0
-        cond_assignment_probs = torch.zeros(len(comb), self.num_grid_cells, self.num_grid_cells, self.num_orientation_cells)
-        assignment_probs = torch.zeros(len(comb), self.num_grid_cells, self.num_grid_cells, self.num_orientation_cells)
-        for assignment_idx in range(len(comb)):
-            probs = self.world_x * 0.0 + 1.0
-            for idx in range(2):
-                if comb[assignment_idx][idx] == False:
-                    probs = probs * (1.0-self.object_dictionary[self.object_list[idx]].detection_probabilities)
-                else:
-                    probs = probs * self.object_dictionary[self.object_list[idx]].detection_probabilities
-            assignments = [i for i, x in enumerate(comb[assignment_idx]) if x]
-            assignment_probs[assignment_idx] = probs
-            cond_assignment_probs[assignment_idx] = self.probmessage_cond_a(detections, assignments)
-        joint_probs = cond_assignment_probs * assignment_probs
-        tot_probs = joint_probs.sum(axis=0)
+        compatible = [[label == name for name in self.object_list] for label in detections.labels]
+        cache = {}
+        for idx in range(len(detections.labels)):
+            if not any(compatible[idx]):
+                continue
+            object_probs = self.prob_map(self.object_bounding_boxes,
+                                         BoundingBoxes(*(coord[idx] for coord in detections.bounding_boxes)))
+            for object_idx in range(len(self.object_list)):
+                if compatible[idx][object_idx]:
+                    cache[(idx, object_idx)] = object_probs[object_idx]
+        detection_probs = self.object_detection_probabilities
+        missed_probs = 1.0 - detection_probs
+        tot_probs = torch.zeros(self.pose_grid_shape, device=self.device)
+        for visible in itertools.product([False, True], repeat=len(self.object_list)):
+            visible_mask = torch.tensor(visible, device=self.device).view(-1, 1, 1, 1)
+            assignment_probs = torch.where(visible_mask, detection_probs, missed_probs).prod(dim=0)
+            proposals = [idx for idx, is_visible in enumerate(visible) if is_visible]
+            tot_probs.add_(assignment_probs * self.probmessage_cond_a(detections, proposals, cache, compatible))
         return tot_probs, annotated_image
 
     def box_probability(self, boxes):
         """Computes the probability of a bounding box being detected.
         Example: If the bounding box is completely outside the camera field of view, it won't be detected.
         """
-        cons_camera_left_x = torch.clip(boxes.center_x - boxes.width, min=-160, max=+160)
-        cons_camera_right_x = torch.clip(boxes.center_x + boxes.width, min=-160, max=+160)
-        cons_camera_bottom_y = torch.clip(boxes.center_y - boxes.height, min=-120, max=+120)
-        cons_camera_top_y = torch.clip(boxes.center_y + boxes.height, min=-120, max=+120)
-        cons_area = (cons_camera_right_x-cons_camera_left_x)*(cons_camera_top_y-cons_camera_bottom_y)
-        area_ratio = cons_area / ((boxes.width*boxes.height)+cons_area)
-        area_ratio = torch.nan_to_num(area_ratio, nan=0.0)
-        return 0.05 * (1-area_ratio) + 0.95 * area_ratio
+        cons_width = (boxes.center_x + boxes.width).clamp(min=-160, max=+160) - \
+            (boxes.center_x - boxes.width).clamp(min=-160, max=+160)
+        cons_height = (boxes.center_y + boxes.height).clamp(min=-120, max=+120) - \
+            (boxes.center_y - boxes.height).clamp(min=-120, max=+120)
+        cons_area = cons_width * cons_height
+        denominator = (boxes.width*boxes.height)+cons_area
+        # A zero denominator means a degenerate box entirely outside the image.
+        area_ratio = torch.where(denominator > 0, cons_area / denominator.clamp(min=1e-12), 0.0)
+        return 0.05 + 0.9 * area_ratio
 
     def world_to_camera(self, world_point):
         world_translate_x = world_point.x - self.world_x
         world_translate_y = world_point.y - self.world_y
         world_translate_z = world_point.z - self.world_z
-        world_rotate_x = torch.sin(self.world_theta) * world_translate_y + torch.cos(
-            self.world_theta) * world_translate_x
-        world_rotate_y = torch.cos(self.world_theta) * world_translate_y - torch.sin(
-            self.world_theta) * world_translate_x
+        world_rotate_x = self.sin_theta * world_translate_y + self.cos_theta * world_translate_x
+        world_rotate_y = self.cos_theta * world_translate_y - self.sin_theta * world_translate_x
         world_rotate_z = world_translate_z
         camera_pred_x = 160 + f_x * (-world_rotate_y) / (world_rotate_x)
         camera_pred_y = 120 + f_y * -(world_rotate_z) / (world_rotate_x)  # using image coords y=0 means top
@@ -212,9 +220,9 @@ class VisionNav(Node):
         annotated_image = self.publish_annotated_image(filtered_detections, header, image)
 
         if filtered_detections is None:
-            return torch.zeros([self.num_grid_cells, self.num_grid_cells, self.num_orientation_cells]) \
-                    + \
-                (1.0 / (self.num_grid_cells * self.num_grid_cells * self.num_orientation_cells))
+            return torch.full(self.pose_grid_shape,
+                              1.0 / (self.num_grid_cells * self.num_grid_cells * self.num_orientation_cells),
+                              device=self.device)
         return filtered_detections, annotated_image
 
     def mobilenet_to_ros2(self, detection, header):